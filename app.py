@@ -1,8 +1,13 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+import click
 import json
 import sqlite3
 import os
+import gzip
+import shutil
+import threading
+import time
 from datetime import datetime, date, timedelta, timezone
 
 app = Flask(__name__, static_folder='.')
@@ -18,6 +23,17 @@ CORS(app, resources={
 
 DB_FILE = 'users.db'
 
+# Online backup settings (override with environment variables)
+BACKUP_DIR = os.environ.get('BACKUP_DIR', 'backups')
+BACKUP_RETAIN = int(os.environ.get('BACKUP_RETAIN', 7))
+BACKUP_PAGES_PER_STEP = int(os.environ.get('BACKUP_PAGES_PER_STEP', 64))
+BACKUP_STEP_PAUSE = float(os.environ.get('BACKUP_STEP_PAUSE', 0.005))  # seconds
+BACKUP_MAX_RESTARTS = int(os.environ.get('BACKUP_MAX_RESTARTS', 3))
+BACKUP_MAX_STEPPED_SECONDS = float(os.environ.get('BACKUP_MAX_STEPPED_SECONDS', 30))
+BACKUP_STALE_TMP_SECONDS = float(os.environ.get('BACKUP_STALE_TMP_SECONDS', 3600))
+BACKUP_COMPRESS = os.environ.get('BACKUP_COMPRESS', '1') == '1'
+BACKUP_INTERVAL_HOURS = float(os.environ.get('BACKUP_INTERVAL_HOURS', 0))  # 0 disables the scheduler
+
 def get_current_time():
     """Get current time in UTC"""
     return datetime.now(timezone.utc)
@@ -113,6 +129,278 @@ def init_db():
 
 init_db()
 
+# Only guards backups within this process, the CLI and other gunicorn workers don't share it
+_backup_lock = threading.Lock()
+LAST_BACKUP_FILE = 'last_backup.json'
+
+def save_last_backup(result):
+    """Write last-run stats to a sidecar file in BACKUP_DIR so every process reports the same run"""
+    path = os.path.join(BACKUP_DIR, LAST_BACKUP_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(result, f)
+    os.replace(path + '.tmp', path)
+
+def load_last_backup():
+    """Read last-run stats from the sidecar file, None if no backup has run yet"""
+    try:
+        with open(os.path.join(BACKUP_DIR, LAST_BACKUP_FILE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+class _BackupRestartLimit(Exception):
+    pass
+
+_SQLITE_BUSY_OR_LOCKED = (5, 6)  # SQLITE_BUSY, SQLITE_LOCKED
+
+def _copy_db_in_steps(src, dst):
+    """Copy src into dst a few pages per step, pausing between steps so writers are never held up for long"""
+    stats = {'steps': 0, 'pages': 0, 'restarts': 0, 'single_step_fallback': False, 'max_step_ms': 0.0}
+    started = time.perf_counter()
+    last = [started]
+    copied_before = [None]
+
+    def progress(status, remaining, total):
+        step = time.perf_counter() - last[0]
+        stats['steps'] += 1
+        stats['pages'] = total
+        stats['max_step_ms'] = max(stats['max_step_ms'], step * 1000)
+        # A write from another connection makes SQLite start the copy over from page 0, so a step
+        # that copied pages without moving past the previous one means it restarted. BUSY/LOCKED
+        # steps copy nothing and are just retried.
+        if status not in _SQLITE_BUSY_OR_LOCKED:
+            copied = total - remaining
+            if copied_before[0] is not None and copied <= copied_before[0]:
+                stats['restarts'] += 1
+            copied_before[0] = copied
+        if stats['restarts'] > BACKUP_MAX_RESTARTS or time.perf_counter() - started > BACKUP_MAX_STEPPED_SECONDS:
+            raise _BackupRestartLimit()
+        # The source is only read-locked inside a step, so sleeping here lets clock-in writes through
+        time.sleep(BACKUP_STEP_PAUSE)
+        last[0] = time.perf_counter()
+
+    try:
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP, progress=progress)
+    except _BackupRestartLimit:
+        # Steady writes keep restarting the paused copy, so finish in a single step. This holds the
+        # read lock for the whole copy, but it can't be restarted and writers only wait that once.
+        stats['single_step_fallback'] = True
+        step_started = time.perf_counter()
+        src.backup(dst)
+        stats['max_step_ms'] = max(stats['max_step_ms'], (time.perf_counter() - step_started) * 1000)
+    stats['max_step_ms'] = round(stats['max_step_ms'], 2)
+    return stats
+
+def list_backups():
+    """List snapshots in BACKUP_DIR, newest first"""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    backups = []
+    for name in os.listdir(BACKUP_DIR):
+        if name.startswith('users-') and (name.endswith('.db') or name.endswith('.db.gz')):
+            try:
+                size = os.path.getsize(os.path.join(BACKUP_DIR, name))
+            except FileNotFoundError:
+                continue  # Pruned by another worker or the CLI since listdir
+            backups.append({'file': name, 'size_bytes': size, 'compressed': name.endswith('.gz')})
+    # Names embed a UTC timestamp, so sorting by name sorts by age
+    backups.sort(key=lambda b: b['file'], reverse=True)
+    return backups
+
+def _remove_stale_tmp_files():
+    """Delete partial snapshots left by a worker that was killed mid-backup, returns the removed file names"""
+    removed = []
+    if not os.path.isdir(BACKUP_DIR):
+        return removed
+    for name in os.listdir(BACKUP_DIR):
+        if not (name.startswith('users-') and name.endswith('.tmp')):
+            continue
+        path = os.path.join(BACKUP_DIR, name)
+        try:
+            # Another process may be writing a fresh one, so only remove files it has stopped touching
+            if time.time() - os.path.getmtime(path) < BACKUP_STALE_TMP_SECONDS:
+                continue
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        removed.append(name)
+    return removed
+
+def prune_backups(retain=None):
+    """Delete the oldest snapshots beyond the retention count and stale partial files, returns the removed file names"""
+    retain = BACKUP_RETAIN if retain is None else retain
+    # Callers hold _backup_lock, so none of this process's backups or restores has a .tmp file open
+    removed = _remove_stale_tmp_files()
+    for b in list_backups()[max(retain, 1):]:
+        try:
+            os.remove(os.path.join(BACKUP_DIR, b['file']))
+        except FileNotFoundError:
+            continue  # Another process pruned it first
+        removed.append(b['file'])
+    return removed
+
+def _run_backup(compress, prune):
+    """Take a snapshot and record its timings, the caller must hold _backup_lock"""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    started = time.perf_counter()
+    stamp = get_current_time().strftime('%Y%m%dT%H%M%S%fZ')
+    path = os.path.join(BACKUP_DIR, f'users-{stamp}.db')
+    tmp_path = path + '.tmp'
+    gz_tmp_path = path + '.gz.tmp'
+
+    try:
+        src = sqlite3.connect(DB_FILE)
+        dst = sqlite3.connect(tmp_path)
+        try:
+            stats = _copy_db_in_steps(src, dst)
+        finally:
+            dst.close()
+            src.close()
+        copy_seconds = time.perf_counter() - started
+
+        if compress:
+            compress_started = time.perf_counter()
+            with open(tmp_path, 'rb') as f_in, gzip.open(gz_tmp_path, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.replace(gz_tmp_path, path + '.gz')
+            path += '.gz'
+            compress_seconds = time.perf_counter() - compress_started
+        else:
+            os.replace(tmp_path, path)
+            compress_seconds = 0.0
+    finally:
+        # Don't leave partial snapshots behind if the copy or gzip failed
+        for leftover in (tmp_path, gz_tmp_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    result = {
+        'file': os.path.basename(path),
+        'created_at': get_current_time_iso(),
+        'size_bytes': os.path.getsize(path),
+        'compressed': compress,
+        'pages': stats['pages'],
+        'steps': stats['steps'],
+        'restarts': stats['restarts'],
+        'single_step_fallback': stats['single_step_fallback'],
+        'max_step_ms': stats['max_step_ms'],
+        'copy_seconds': round(copy_seconds, 3),
+        'compress_seconds': round(compress_seconds, 3),
+        'total_seconds': round(time.perf_counter() - started, 3),
+    }
+    result['pruned'] = []
+    # Record the snapshot before pruning so a pruning problem can't make it look like it failed
+    save_last_backup(result)
+    if prune:
+        try:
+            result['pruned'] = prune_backups()
+        except OSError as e:
+            app.logger.warning('Pruning old backups failed: %s', e)
+        save_last_backup(result)
+    return result
+
+def backup_db(compress=None):
+    """Take an online snapshot of DB_FILE without pausing traffic and return timings"""
+    compress = BACKUP_COMPRESS if compress is None else compress
+    if not _backup_lock.acquire(blocking=False):
+        raise RuntimeError('Backup already in progress')
+    try:
+        return _run_backup(compress, prune=True)
+    finally:
+        _backup_lock.release()
+
+def start_backup(compress=None):
+    """Start a backup in a background thread so the calling request isn't held up, poll load_last_backup() for the result"""
+    compress = BACKUP_COMPRESS if compress is None else compress
+    if not _backup_lock.acquire(blocking=False):
+        raise RuntimeError('Backup already in progress')
+
+    def run():
+        try:
+            _run_backup(compress, prune=True)
+        except Exception as e:
+            app.logger.error('Backup failed: %s', e)
+            save_last_backup({'error': str(e), 'failed_at': get_current_time_iso()})
+        finally:
+            _backup_lock.release()
+
+    threading.Thread(target=run, daemon=True).start()
+
+def restore_db(name):
+    """Restore DB_FILE from a snapshot in BACKUP_DIR, taking a safety snapshot of the current data first"""
+    # Only complete snapshots are restorable, never leftover .tmp files
+    if name not in [b['file'] for b in list_backups()]:
+        raise FileNotFoundError(f'Backup not found: {name}')
+    path = os.path.join(BACKUP_DIR, name)
+    if not _backup_lock.acquire(blocking=False):
+        raise RuntimeError('Backup already in progress')
+    tmp_path = None
+    try:
+        if path.endswith('.gz'):
+            tmp_path = path[:-len('.gz')] + '.restore.tmp'
+            with gzip.open(path, 'rb') as f_in, open(tmp_path, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            path = tmp_path
+
+        src = sqlite3.connect(path)
+        try:
+            if src.execute('PRAGMA integrity_check').fetchone()[0] != 'ok':
+                raise ValueError(f'Backup failed integrity check: {name}')
+            # Keep the current data in case the restore was a mistake. Pruning is left to the
+            # next regular backup so it can never remove the snapshot being restored.
+            safety = _run_backup(BACKUP_COMPRESS, prune=False)
+            started = time.perf_counter()
+            dst = sqlite3.connect(DB_FILE, timeout=30)
+            try:
+                src.backup(dst)
+            finally:
+                dst.close()
+        finally:
+            src.close()
+        return {
+            'restored_from': name,
+            'safety_backup': safety['file'],
+            'restore_seconds': round(time.perf_counter() - started, 3),
+        }
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        _backup_lock.release()
+
+def _next_backup_due():
+    """Work out when the next scheduled backup is due from the last recorded run"""
+    last = load_last_backup() or {}
+    last_run = parse_datetime_iso(last.get('created_at') or last.get('failed_at'))
+    if last_run is None:
+        return get_current_time()
+    return last_run + timedelta(hours=BACKUP_INTERVAL_HOURS)
+
+def _backup_scheduler():
+    # The schedule comes from last_backup.json rather than process start, so restarts and deploys
+    # don't keep pushing the next backup back
+    while True:
+        wait = (_next_backup_due() - get_current_time()).total_seconds()
+        if wait > 0:
+            # Re-check afterwards, another worker or a manual backup may have run meanwhile
+            time.sleep(wait)
+            continue
+        try:
+            result = backup_db()
+            app.logger.info('Scheduled backup %s took %ss (longest step %sms)', result['file'], result['total_seconds'], result['max_step_ms'])
+        except RuntimeError:
+            pass  # A manual backup is already running and will record its own result
+        except Exception as e:
+            app.logger.error('Scheduled backup failed: %s', e)
+            try:
+                save_last_backup({'error': str(e), 'failed_at': get_current_time_iso()})
+            except OSError:
+                pass
+        # Don't spin if the result couldn't be recorded
+        time.sleep(60)
+
+if BACKUP_INTERVAL_HOURS > 0:
+    threading.Thread(target=_backup_scheduler, daemon=True).start()
+
 def get_all_users():
     conn = sqlite3.connect(DB_FILE)
     c = conn.cursor()
@@ -655,6 +943,45 @@ def debug_user(username):
     else:
         return jsonify({'error': 'User not found'}), 404
 
+@app.route("/admin/backup", methods=["POST"])
+def admin_backup():
+    """Start an online backup in the background (admin only)"""
+    data = request.json
+    if not isinstance(data, dict) or "admin_username" not in data:
+        return jsonify({"error": "Missing fields"}), 400
+    if not is_admin(data["admin_username"]):
+        return jsonify({"error": "Unauthorized - Admin privileges required"}), 403
+    compress = data.get("compress")
+    if compress is not None and not isinstance(compress, bool):
+        return jsonify({"error": "compress must be true or false"}), 400
+    try:
+        start_backup(compress=compress)
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 409
+    return jsonify({"message": "Backup started, poll /admin/backups for the result"}), 202
+
+@app.route("/admin/backups", methods=["GET"])
+def admin_list_backups():
+    """List snapshots and the timings of the last backup (admin only)"""
+    admin_username = request.args.get("admin_username")
+    if not admin_username:
+        return jsonify({"error": "Missing fields"}), 400
+    if not is_admin(admin_username):
+        return jsonify({"error": "Unauthorized - Admin privileges required"}), 403
+    return jsonify({"backups": list_backups(), "last_backup": load_last_backup()}), 200
+
+@app.cli.command("backup-db")
+@click.option("--compress/--no-compress", default=None, help="Gzip the snapshot (defaults to BACKUP_COMPRESS)")
+def backup_db_command(compress):
+    """Take an online snapshot of the database"""
+    click.echo(json.dumps(backup_db(compress=compress), indent=2))
+
+@app.cli.command("restore-db")
+@click.argument("name")
+def restore_db_command(name):
+    """Restore the database from a snapshot in BACKUP_DIR"""
+    click.echo(json.dumps(restore_db(name), indent=2))
+
 if __name__ == '__main__':
     app.run(debug=True)
 